@@ -1,16 +1,31 @@
 import os
 import json
-import re
+import asyncio
+import hashlib
+from collections import Counter, defaultdict
+from dataclasses import dataclass, asdict
+from functools import lru_cache
+import math
+import shelve
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from asgiref.wsgi import WsgiToAsgi
 from dotenv import load_dotenv
 import google.generativeai as genai
-import markdown2
+import msgspec
+import numpy as np
+import orjson
 from markupsafe import Markup
-import PyPDF2
-import docx
-from io import BytesIO
+
+# PyPDF2, docx, and markdown2 are imported lazily inside the handlers that
+# need them, keeping worker cold-start and resident memory down
 
 # Load environment variables
 load_dotenv()
@@ -22,47 +37,657 @@ model = genai.GenerativeModel("gemini-2.5-flash")
 
 app = Flask(__name__)
 CORS(app)
+app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # reject oversized uploads up front
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Serialize API responses with orjson instead of stdlib json"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+app.json = OrjsonProvider(app)
+
+@dataclass(slots=True)
+class DocMeta:
+    """Hot per-document metadata, kept apart from the cold content blob"""
+    filename: str
+    doc_type: str
+    upload_time: str
+    processed: bool = False
+
+# Durable key/value store: SQLite with per-row TTL, so documents and analyses
+# survive restarts, stay bounded via expiry, and are shared across workers on
+# a host instead of living in one process's dicts. Metadata and content keep
+# separate keys so metadata scans never deserialize the large content blobs
+STORE_PATH = os.getenv("LEXIGUARD_DB_PATH", "lexiguard.db")
+DOC_TTL_SECONDS = 86400
+ANALYSIS_TTL_SECONDS = 3600
+
+def _store_conn():
+    conn = sqlite3.connect(STORE_PATH)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+def _init_store():
+    with _store_conn() as conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv_store ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+_init_store()
+
+def store_set(key, value, ttl):
+    """Store a JSON-serializable value with a TTL, evicting expired rows"""
+    now = time.time()
+    with _store_conn() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO kv_store (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, orjson.dumps(value).decode(), now + ttl)
+        )
+        conn.execute("DELETE FROM kv_store WHERE expires_at < ?", (now,))
+
+def store_get(key):
+    """Fetch a value by key, or None if missing or expired"""
+    with _store_conn() as conn:
+        row = conn.execute(
+            "SELECT value FROM kv_store WHERE key = ? AND expires_at >= ?",
+            (key, time.time())
+        ).fetchone()
+    return orjson.loads(row[0]) if row else None
+
+def get_document_meta(doc_id):
+    raw = store_get(f"doc_meta:{doc_id}")
+    return DocMeta(**raw) if raw else None
+
+def get_document_content(doc_id):
+    return store_get(f"doc_content:{doc_id}")
+
+def store_document(doc_id, meta, content):
+    store_set(f"doc_meta:{doc_id}", asdict(meta), DOC_TTL_SECONDS)
+    store_set(f"doc_content:{doc_id}", content, DOC_TTL_SECONDS)
+
+def mark_document_processed(doc_id):
+    # Rewrite both keys so the meta and content TTLs stay in lockstep;
+    # refreshing only the meta would let it outlive its content
+    meta = get_document_meta(doc_id)
+    content = get_document_content(doc_id)
+    if meta is not None and content is not None:
+        meta.processed = True
+        store_document(doc_id, meta, content)
+
+def list_document_metas():
+    """Yield (doc_id, DocMeta) for all live documents"""
+    with _store_conn() as conn:
+        rows = conn.execute(
+            "SELECT key, value FROM kv_store WHERE key LIKE 'doc_meta:%' AND expires_at >= ?",
+            (time.time(),)
+        ).fetchall()
+    for key, value in rows:
+        yield key.removeprefix("doc_meta:"), DocMeta(**orjson.loads(value))
+
+def store_analysis(key, result):
+    store_set(f"analysis:{key}", result, ANALYSIS_TTL_SECONDS)
+
+def get_analysis(key):
+    return store_get(f"analysis:{key}")
+
+def delete_analysis(key):
+    with _store_conn() as conn:
+        conn.execute("DELETE FROM kv_store WHERE key = ?", (f"analysis:{key}",))
+
+# Static instruction blocks hoisted out of the per-request f-strings. Keeping
+# them as the leading segment of every prompt lets Gemini's context-caching API
+# reuse the prefill KV for the shared prefix instead of re-encoding it per call
+SYSTEM_PREFIX_CLAUSES = """You are a senior legal analyst with expertise in contract law and regulatory compliance.
+
+Analyze the legal document provided at the end of this prompt and extract ALL distinct clauses with precise semantic understanding.
+
+For EACH clause, provide:
+1. **Clause Type** (e.g., Data Retention, Liability, Termination, Data Handling, Consent, Jurisdiction, Payment, Indemnification, Confidentiality, etc.)
+2. **Clause Text** (exact text or summary)
+3. **Risk Potential** (Low, Medium, High, Critical) - based on common legal risks
+4. **Key Obligations** - what this clause requires
+5. **Implicit Assumptions** - unstated but implied requirements
+
+Return your analysis in valid JSON format:
+{
+  "clauses": [
+    {
+      "clause_id": "C1",
+      "clause_type": "Data Retention",
+      "text": "exact clause text...",
+      "risk_potential": "High",
+      "key_obligations": ["obligation 1", "obligation 2"],
+      "implicit_assumptions": ["assumption 1"],
+      "location": "Section 4.2"
+    }
+  ],
+  "summary": "Brief overview of document structure"
+}
+
+Be thorough and extract ALL meaningful clauses. Use precise legal language."""
+
+SYSTEM_PREFIX_COMPLIANCE = """You are an expert legal compliance analyst specializing in regulatory risk assessment.
+
+Perform comprehensive compliance analysis for the document provided at the end of this prompt against the specified regulations.
+
+Perform deep legal reasoning to identify:
+
+1. **Direct Violations** - clauses that explicitly violate regulations
+2. **Partial Compliance** - clauses that partially meet requirements but have gaps
+3. **Missing Clauses** - required clauses absent from the document
+4. **Contradictory Obligations** - internal conflicts or cross-regulation conflicts
+5. **Regulatory Mapping** - map each clause to relevant regulation articles
+
+For EACH issue found, provide:
+- **Issue Type** (violation, gap, conflict, partial)
+- **Severity** (Low, Medium, High, Critical)
+- **Affected Clause** (clause_id and text)
+- **Regulation** (which regulation and specific article)
+- **Legal Reasoning** (explain WHY this is a problem using legal principles)
+- **Penalty Exposure** (potential consequences)
+- **Remediation** (specific actionable fix)
+
+Return analysis in valid JSON:
+{
+  "compliance_score": 0-100,
+  "total_issues": number,
+  "issues": [
+    {
+      "issue_id": "I1",
+      "issue_type": "violation",
+      "severity": "Critical",
+      "affected_clause_id": "C1",
+      "clause_text": "...",
+      "regulation": "GDPR Article 17",
+      "legal_reasoning": "This clause permits indefinite data storage, which directly conflicts with GDPR Article 5(1)(e) requiring data minimization and storage limitation. Under GDPR, personal data must not be kept longer than necessary.",
+      "penalty_exposure": "Up to €20 million or 4% of annual global turnover",
+      "remediation": "Introduce maximum retention period of 24 months with documented justification"
+    }
+  ],
+  "regulation_coverage": {},
+  "risk_summary": "Executive summary"
+}
+
+Use precise legal reasoning. Ground all findings in provided text."""
+
+SYSTEM_PREFIX_REMEDIATION = """You are a legal operations strategist creating an actionable remediation plan.
+
+Based on the compliance analysis provided at the end of this prompt, create a prioritized remediation roadmap that includes:
+
+1. **Immediate Actions** (Critical severity - do within 7 days)
+2. **Short-term Fixes** (High severity - do within 30 days)
+3. **Medium-term Improvements** (Medium severity - do within 90 days)
+4. **Long-term Enhancements** (Low severity - continuous improvement)
+
+For EACH recommendation:
+- **Action Title** - clear, specific task
+- **Detailed Steps** - how to implement
+- **Responsible Party** - who should do this (Legal, Engineering, Compliance, etc.)
+- **Estimated Effort** - time/resources required
+- **Dependencies** - what needs to happen first
+- **Success Criteria** - how to verify completion
+
+Return as valid JSON:
+{
+  "plan_summary": "Executive overview",
+  "immediate_actions": [],
+  "short_term": [],
+  "medium_term": [],
+  "long_term": [],
+  "estimated_timeline": "X weeks",
+  "total_actions": number
+}
+
+Make recommendations specific and actionable, not generic advice."""
+
+# Server-side prefix caching: one CachedContent handle per static prefix,
+# refreshed shortly before Gemini's TTL expires. Failures are negative-cached
+# so an API key or prefix that cannot use context caching (e.g. below the
+# minimum cached-content size) does not cost an extra failed round-trip on
+# every request
+PREFIX_CACHE_TTL_SECONDS = 3600
+PREFIX_CACHE_REFRESH_MARGIN = 300
+PREFIX_CACHE_RETRY_SECONDS = 600
+
+_prefix_lock = threading.Lock()
+_prefix_models = {}  # namespace -> (model bound to cached prefix or None, timestamp)
+
+def _model_for_prefix(namespace, prefix):
+    """Return a model bound to a server-side cached copy of the static prefix.
+
+    Falls back to None (caller sends the full prompt) if context caching is
+    unavailable, and remembers the failure for PREFIX_CACHE_RETRY_SECONDS.
+    """
+    now = time.time()
+    with _prefix_lock:
+        entry = _prefix_models.get(namespace)
+        if entry:
+            prefix_model, created_at = entry
+            if prefix_model is None:
+                if now - created_at < PREFIX_CACHE_RETRY_SECONDS:
+                    return None
+            elif now - created_at < PREFIX_CACHE_TTL_SECONDS - PREFIX_CACHE_REFRESH_MARGIN:
+                return prefix_model
+    try:
+        cached = genai.caching.CachedContent.create(
+            model="gemini-2.5-flash",
+            contents=[prefix],
+            ttl=f"{PREFIX_CACHE_TTL_SECONDS}s"
+        )
+        prefix_model = genai.GenerativeModel.from_cached_content(cached)
+    except Exception:
+        prefix_model = None
+    with _prefix_lock:
+        _prefix_models[namespace] = (prefix_model, now)
+    return prefix_model
+
+# Semantic response cache for Gemini calls: an exact md5 tier backed by a
+# cosine-similarity tier over prompt embeddings, persisted via shelve
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", ".lexiguard_semantic_cache")
+SEMANTIC_CACHE_THRESHOLD = 0.97
+EMBEDDING_MODEL = "models/text-embedding-004"
+
+_cache_lock = threading.Lock()
+_exact_cache = {}      # md5(prompt) -> cached response text
+_embedding_index = {}  # namespace -> list of (normalized embedding, cache key)
+
+def _load_semantic_cache():
+    """Hydrate the in-memory cache tiers from the shelve file"""
+    try:
+        with shelve.open(SEMANTIC_CACHE_PATH) as db:
+            for full_key, entry in db.items():
+                namespace, key = full_key.split(":", 1)
+                _exact_cache[key] = entry["text"]
+                _embedding_index.setdefault(namespace, []).append((entry["embedding"], key))
+    except Exception:
+        pass  # corrupt or missing cache file, start cold
+
+_load_semantic_cache()
+
+def _embed_prompt(prompt):
+    """Embed a prompt and normalize it so dot product equals cosine similarity"""
+    result = genai.embed_content(model=EMBEDDING_MODEL, content=prompt)
+    embedding = result["embedding"]
+    norm = math.sqrt(sum(v * v for v in embedding))
+    return [v / norm for v in embedding] if norm else embedding
+
+def _persist_cache_entry(namespace, key, embedding, response_text):
+    """Best-effort write of a cache entry to the shelve file"""
+    try:
+        with shelve.open(SEMANTIC_CACHE_PATH) as db:
+            db[f"{namespace}:{key}"] = {"embedding": embedding, "text": response_text}
+    except Exception:
+        pass
+
+async def cached_generate(prompt, namespace, prefix=None):
+    """Call Gemini with a two-tier cache: exact prompt hash, then semantic lookup.
+
+    Near-identical prompts (cosine >= SEMANTIC_CACHE_THRESHOLD) reuse the stored
+    response instead of paying another multi-second Gemini round-trip. When a
+    static prefix is given, generation goes through a server-side cached copy of
+    it so Gemini skips prefill of the shared instruction block. Async so the
+    worker is released during the LLM HTTP wait instead of pinning a thread.
+    """
+    full_prompt = f"{prefix}\n\n{prompt}" if prefix else prompt
+    key = hashlib.md5(full_prompt.encode("utf-8")).hexdigest()
+
+    with _cache_lock:
+        if key in _exact_cache:
+            return _exact_cache[key]
+
+    embedding = None
+    try:
+        embedding = await asyncio.to_thread(_embed_prompt, full_prompt)
+        with _cache_lock:
+            candidates = list(_embedding_index.get(namespace, []))
+        best_score, best_key = 0.0, None
+        for cached_embedding, cached_key in candidates:
+            score = sum(a * b for a, b in zip(embedding, cached_embedding))
+            if score > best_score:
+                best_score, best_key = score, cached_key
+        if best_key is not None and best_score >= SEMANTIC_CACHE_THRESHOLD:
+            with _cache_lock:
+                if best_key in _exact_cache:
+                    return _exact_cache[best_key]
+    except Exception:
+        pass  # embedding failure falls through to a normal Gemini call
+
+    prefix_model = await asyncio.to_thread(_model_for_prefix, namespace, prefix) if prefix else None
+    if prefix_model is not None:
+        response = await prefix_model.generate_content_async(prompt)
+    else:
+        response = await model.generate_content_async(full_prompt)
+    response_text = response.text
+
+    with _cache_lock:
+        _exact_cache[key] = response_text
+        if embedding is not None:
+            _embedding_index.setdefault(namespace, []).append((embedding, key))
+    if embedding is not None:
+        await asyncio.to_thread(_persist_cache_entry, namespace, key, embedding, response_text)
+
+    return response_text
+
+# Typed schemas for the JSON Gemini returns. msgspec decodes and validates in
+# one C-level pass, surfacing malformed LLM output at the parse site instead of
+# as a KeyError downstream. Fields default rather than fail so a model that
+# omits an optional key does not reject the whole response
+class Clause(msgspec.Struct):
+    clause_id: str = ""
+    clause_type: str = ""
+    text: str = ""
+    risk_potential: str = ""
+    key_obligations: list[str] = []
+    implicit_assumptions: list[str] = []
+    location: str | None = None
+
+class ClauseResponse(msgspec.Struct):
+    clauses: list[Clause] = []
+    summary: str = ""
+
+class ComplianceIssue(msgspec.Struct):
+    issue_id: str = ""
+    issue_type: str = ""
+    severity: str = ""
+    affected_clause_id: str = ""
+    clause_text: str = ""
+    regulation: str = ""
+    legal_reasoning: str = ""
+    penalty_exposure: str = ""
+    remediation: str = ""
+
+class ComplianceResponse(msgspec.Struct):
+    compliance_score: float = 0
+    total_issues: int = 0
+    issues: list[ComplianceIssue] = []
+    regulation_coverage: dict = {}
+    risk_summary: str = ""
+
+class RemediationPlan(msgspec.Struct):
+    plan_summary: str = ""
+    immediate_actions: list[dict] = []
+    short_term: list[dict] = []
+    medium_term: list[dict] = []
+    long_term: list[dict] = []
+    estimated_timeline: str = ""
+    total_actions: int = 0
+
+_clause_decoder = msgspec.json.Decoder(ClauseResponse)
+_compliance_decoder = msgspec.json.Decoder(ComplianceResponse)
+_remediation_decoder = msgspec.json.Decoder(RemediationPlan)
+
+def decode_response(decoder, response_text):
+    """Decode a fence-stripped Gemini response against its typed schema.
+
+    Returns plain dicts/lists so the rest of the pipeline (merging, caching,
+    jsonify) is unchanged.
+    """
+    return msgspec.to_builtins(decoder.decode(_strip_md_fences(response_text).encode()))
+
+# Chunking budget for clause extraction, in Gemini tokens. Chunks overlap so
+# clauses spanning a boundary are seen whole by at least one call
+CLAUSE_CHUNK_TOKENS = 8000
+CLAUSE_CHUNK_OVERLAP_TOKENS = 1000
+APPROX_CHARS_PER_TOKEN = 4
+
+def count_document_tokens(text):
+    """Count tokens via the Gemini tokenizer, estimating by chars on failure"""
+    try:
+        return model.count_tokens(text).total_tokens
+    except Exception:
+        return len(text) // APPROX_CHARS_PER_TOKEN
+
+def chunk_document_content(content):
+    """Split document content into overlapping extraction-sized chunks.
+
+    Documents that fit the per-call token budget come back as a single chunk;
+    longer ones are split so the whole document is analyzed instead of being
+    silently truncated.
+    """
+    if count_document_tokens(content) <= CLAUSE_CHUNK_TOKENS:
+        return [content]
+    chunk_chars = CLAUSE_CHUNK_TOKENS * APPROX_CHARS_PER_TOKEN
+    step_chars = (CLAUSE_CHUNK_TOKENS - CLAUSE_CHUNK_OVERLAP_TOKENS) * APPROX_CHARS_PER_TOKEN
+    return [content[i:i + chunk_chars] for i in range(0, len(content), step_chars)]
+
+def merge_clause_results(partials):
+    """Merge per-chunk clause extractions, deduping overlap-region repeats"""
+    clauses = []
+    seen = set()
+    summaries = []
+    for partial in partials:
+        for clause in partial.get("clauses", []):
+            fingerprint = " ".join(str(clause.get("text", "")).lower().split())
+            if fingerprint in seen:
+                continue
+            seen.add(fingerprint)
+            clause["clause_id"] = f"C{len(clauses) + 1}"
+            clauses.append(clause)
+        if partial.get("summary"):
+            summaries.append(partial["summary"])
+    return {"clauses": clauses, "summary": " ".join(summaries)}
+
+REGULATIONS_CONTEXT = {
+    "GDPR": "EU General Data Protection Regulation - focuses on data subject rights, consent, data minimization, retention limits, right to erasure, breach notification",
+    "HIPAA": "Health Insurance Portability and Accountability Act - protects health information privacy, requires security safeguards, breach notification",
+    "CCPA": "California Consumer Privacy Act - consumer rights to know, delete, opt-out of data sales",
+    "SOC2": "System and Organization Controls 2 - security, availability, processing integrity, confidentiality, privacy",
+    "PCI-DSS": "Payment Card Industry Data Security Standard - protect cardholder data, secure networks, access control"
+}
+
+# Serialized once at module load; the handler only concatenates
+REG_JSON = {name: orjson.dumps({name: desc}, option=orjson.OPT_INDENT_2).decode() for name, desc in REGULATIONS_CONTEXT.items()}
+
+def build_single_reg_prompt(filename, clauses_json, reg_json):
+    """Build the variable prompt tail for a single-regulation compliance pass"""
+    return f"""Document: {filename}
+Extracted Clauses Analysis:
+{clauses_json}
+
+Regulations to Check:
+{reg_json}"""
+
+def merge_compliance_results(response_texts):
+    """Merge per-regulation compliance responses into one analysis.
 
-# In-memory storage for demo purposes
-documents_db = {}
-analysis_cache = {}
+    Issues are concatenated with re-indexed ids, scores averaged, and
+    coverage maps unioned.
+    """
+    issues = []
+    scores = []
+    regulation_coverage = {}
+    risk_summaries = []
+    for response_text in response_texts:
+        partial = decode_response(_compliance_decoder, response_text)
+        for issue in partial.get("issues", []):
+            issue["issue_id"] = f"I{len(issues) + 1}"
+            issues.append(issue)
+        if isinstance(partial.get("compliance_score"), (int, float)):
+            scores.append(partial["compliance_score"])
+        regulation_coverage.update(partial.get("regulation_coverage", {}))
+        if partial.get("risk_summary"):
+            risk_summaries.append(partial["risk_summary"])
+    return {
+        "compliance_score": round(sum(scores) / len(scores)) if scores else 0,
+        "total_issues": len(issues),
+        "issues": issues,
+        "regulation_coverage": regulation_coverage,
+        "risk_summary": "\n".join(risk_summaries)
+    }
 
-def extract_text_from_pdf(file_bytes):
+def _strip_md_fences(text):
+    """Strip a leading ```json fence and trailing ``` via plain string ops"""
+    text = text.strip()
+    text = text.removeprefix("```json").removeprefix("```")
+    return text.removesuffix("```").strip()
+
+ISSUE_DUPLICATE_THRESHOLD = 0.95
+
+def _embed_issue_matrix(issues):
+    """Batch-embed issue texts into a normalized (N, D) float32 matrix"""
+    result = genai.embed_content(
+        model=EMBEDDING_MODEL,
+        content=[issue.get("clause_text") or issue.get("legal_reasoning", "") for issue in issues]
+    )
+    matrix = np.asarray(result["embedding"], dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+def find_duplicate_issue_pairs(issues):
+    """Flag cosine-similar issue pairs — typically the same clause raised under
+    several regulations — with one batched embedding call and one matmul."""
+    try:
+        embeddings = _embed_issue_matrix(issues)
+    except Exception:
+        return None  # embedding unavailable; caller must not cache this
+    similarity = embeddings @ embeddings.T
+    pairs = np.argwhere(np.triu(similarity, k=1) > ISSUE_DUPLICATE_THRESHOLD)
+    return [
+        {
+            "issue_a": issues[i].get("issue_id"),
+            "issue_b": issues[j].get("issue_id"),
+            "similarity": float(similarity[i, j])
+        }
+        for i, j in pairs
+    ]
+
+_md = None
+
+def _md_converter():
+    """Lazily build the shared markdown2.Markdown instance"""
+    global _md
+    if _md is None:
+        import markdown2
+        _md = markdown2.Markdown(extras=["fenced-code-blocks", "tables", "strike", "cuddled-lists"])
+    return _md
+
+@lru_cache(maxsize=512)
+def md_to_html(text):
+    """Convert markdown to HTML, memoized since semantic-cache hits repeat text"""
+    return _md_converter().convert(text)
+
+def _iter_clause_objects(chunks):
+    """Incrementally parse clause objects out of a streamed Gemini response.
+
+    Scans the accumulating text for the "clauses" array and yields each
+    complete top-level object as soon as its closing brace arrives, without
+    waiting for generation to finish.
+    """
+    buf = ""
+    pos = 0
+    in_array = False
+    in_string = False
+    escaped = False
+    depth = 0
+    start = None
+    for chunk in chunks:
+        buf += chunk
+        if not in_array:
+            key_idx = buf.find('"clauses"')
+            if key_idx == -1:
+                continue
+            bracket_idx = buf.find('[', key_idx)
+            if bracket_idx == -1:
+                continue
+            in_array = True
+            pos = bracket_idx + 1
+        while pos < len(buf):
+            ch = buf[pos]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == '\\':
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch == '{':
+                if depth == 0:
+                    start = pos
+                depth += 1
+            elif ch == '}':
+                depth -= 1
+                if depth == 0 and start is not None:
+                    yield json.loads(buf[start:pos + 1])
+                    start = None
+            elif ch == ']' and depth == 0:
+                return
+            pos += 1
+
+def extract_text_from_pdf(file_obj):
     """Extract text from PDF file"""
+    # PyPDF2 resolves objects lazily through seek/read on the one underlying
+    # stream and is not thread-safe, so pages must be extracted serially
     try:
-        pdf_reader = PyPDF2.PdfReader(BytesIO(file_bytes))
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text() + "\n"
-        return text
+        import PyPDF2
+        pdf_reader = PyPDF2.PdfReader(file_obj)
+        return "\n".join(page.extract_text() or "" for page in pdf_reader.pages)
     except Exception as e:
         return f"Error extracting PDF: {str(e)}"
 
-def extract_text_from_docx(file_bytes):
+def extract_text_from_docx(file_obj):
     """Extract text from DOCX file"""
     try:
-        doc = docx.Document(BytesIO(file_bytes))
-        text = ""
-        for para in doc.paragraphs:
-            text += para.text + "\n"
-        return text
+        import docx
+        doc = docx.Document(file_obj)
+        return "\n".join(para.text for para in doc.paragraphs)
     except Exception as e:
         return f"Error extracting DOCX: {str(e)}"
 
+EXTRACT_CACHE_TTL_SECONDS = 604800  # re-uploads of the same bytes are common
+UPLOAD_SPOOL_MAX_BYTES = 8 * 1024 * 1024
+UPLOAD_CHUNK_BYTES = 64 * 1024
+
 def extract_text_from_file(file):
-    """Extract text based on file type"""
-    filename = file.filename.lower()
-    file_bytes = file.read()
-    
-    if filename.endswith('.pdf'):
-        return extract_text_from_pdf(file_bytes)
-    elif filename.endswith('.docx'):
-        return extract_text_from_docx(file_bytes)
-    elif filename.endswith('.txt'):
-        return file_bytes.decode('utf-8')
+    """Extract text based on sniffed file type, memoized on a hash of the bytes"""
+    # Sniff the leading bytes so a renamed binary is rejected before the
+    # body gets read anywhere; text files have no magic, so they still go
+    # by extension
+    head = file.stream.read(8)
+    if head.startswith(b"%PDF-"):
+        file_kind = 'pdf'
+    elif head.startswith(b"PK\x03\x04"):
+        file_kind = 'docx'
+    elif file.filename.lower().endswith('.txt'):
+        file_kind = 'txt'
     else:
         return "Unsupported file format"
 
+    # Stream the upload into a spooled temp file, hashing as we go, so the
+    # raw bytes are never held in memory twice (small files stay in RAM,
+    # large ones spill to disk)
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_BYTES)
+    hasher = hashlib.sha256()
+    hasher.update(head)
+    spool.write(head)
+    while chunk := file.stream.read(UPLOAD_CHUNK_BYTES):
+        hasher.update(chunk)
+        spool.write(chunk)
+    spool.seek(0)
+
+    with spool:
+        # Same bytes under a different filename (retry, rename) skip extraction
+        cache_key = f"extract:{hasher.hexdigest()}"
+        cached = store_get(cache_key)
+        if cached is not None:
+            return cached
+
+        if file_kind == 'pdf':
+            text = extract_text_from_pdf(spool)
+        elif file_kind == 'docx':
+            text = extract_text_from_docx(spool)
+        else:
+            text = spool.read().decode('utf-8')
+
+    if not text.startswith("Error"):
+        store_set(cache_key, text, EXTRACT_CACHE_TTL_SECONDS)
+    return text
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -86,18 +711,17 @@ def upload_document():
         if text_content.startswith("Error"):
             return jsonify({"error": text_content}), 400
         
-        # Generate document ID
-        doc_id = f"doc_{len(documents_db) + 1}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-        
+        # Generate document ID: random ids are collision-safe across
+        # concurrent workers, unlike the old count+timestamp scheme
+        doc_id = f"doc_{uuid.uuid4().hex[:12]}"
+
         # Store document
-        documents_db[doc_id] = {
-            "id": doc_id,
-            "filename": file.filename,
-            "doc_type": doc_type,
-            "content": text_content,
-            "upload_time": datetime.now().isoformat(),
-            "processed": False
-        }
+        meta = DocMeta(
+            filename=file.filename,
+            doc_type=doc_type,
+            upload_time=datetime.now().isoformat()
+        )
+        store_document(doc_id, meta, text_content)
         
         return jsonify({
             "success": True,
@@ -110,62 +734,85 @@ def upload_document():
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/extract-clauses', methods=['POST'])
-def extract_clauses():
+async def extract_clauses():
     """Extract and classify semantic clauses from document"""
     try:
         data = request.json
         doc_id = data.get('doc_id')
         
-        if doc_id not in documents_db:
+        meta = get_document_meta(doc_id)
+        if meta is None:
             return jsonify({"error": "Document not found"}), 404
-        
-        document = documents_db[doc_id]
-        
-        prompt = f"""You are a senior legal analyst with expertise in contract law and regulatory compliance.
-
-Analyze the following legal document and extract ALL distinct clauses with precise semantic understanding.
 
-Document Type: {document['doc_type']}
+        # Token-aware chunking: short documents go through in one call, long
+        # ones are mapped over overlapping chunks and reduced afterwards
+        content = get_document_content(doc_id)
+        if content is None:
+            # content expired independently of the metadata row
+            return jsonify({"error": "Document not found"}), 404
+        chunks = chunk_document_content(content)
+        prompts = [
+            f"""Document Type: {meta.doc_type}
 Document Content:
-{document['content'][:15000]}
+{chunk}"""
+            for chunk in chunks
+        ]
+        prompt = prompts[0]
 
-For EACH clause, provide:
-1. **Clause Type** (e.g., Data Retention, Liability, Termination, Data Handling, Consent, Jurisdiction, Payment, Indemnification, Confidentiality, etc.)
-2. **Clause Text** (exact text or summary)
-3. **Risk Potential** (Low, Medium, High, Critical) - based on common legal risks
-4. **Key Obligations** - what this clause requires
-5. **Implicit Assumptions** - unstated but implied requirements
+        # Opt-in streaming: yield each clause as NDJSON while Gemini is still
+        # generating, so the client sees the first clause at first-token time.
+        # Streaming covers a single extraction call, so documents needing the
+        # map-reduce path must use the non-streaming mode — silently analyzing
+        # only the first chunk would poison the stored analysis
+        if data.get('stream'):
+            if len(chunks) > 1:
+                return jsonify({
+                    "error": "Document is too long for streaming extraction; retry without stream"
+                }), 400
+            full_prompt = f"{SYSTEM_PREFIX_CLAUSES}\n\n{prompt}"
 
-Return your analysis in valid JSON format:
-{{
-  "clauses": [
-    {{
-      "clause_id": "C1",
-      "clause_type": "Data Retention",
-      "text": "exact clause text...",
-      "risk_potential": "High",
-      "key_obligations": ["obligation 1", "obligation 2"],
-      "implicit_assumptions": ["assumption 1"],
-      "location": "Section 4.2"
-    }}
-  ],
-  "summary": "Brief overview of document structure"
-}}
+            def event_stream():
+                pieces = []
 
-Be thorough and extract ALL meaningful clauses. Use precise legal language."""
+                def text_chunks():
+                    for chunk in model.generate_content(full_prompt, stream=True):
+                        text = chunk.text or ""
+                        pieces.append(text)
+                        yield text
+
+                chunk_iter = text_chunks()
+                clauses = []
+                for clause in _iter_clause_objects(chunk_iter):
+                    clauses.append(clause)
+                    yield orjson.dumps({"clause": clause}).decode() + "\n"
+
+                # The parser stops at the ] closing the clauses array; drain
+                # the rest of the stream (closing brace, summary) so the
+                # accumulated text is complete JSON for the cache
+                for _ in chunk_iter:
+                    pass
+
+                try:
+                    result = decode_response(_clause_decoder, "".join(pieces))
+                except msgspec.DecodeError:
+                    result = {"clauses": clauses, "summary": ""}
+                store_analysis(doc_id, result)
+                mark_document_processed(doc_id)
+                yield orjson.dumps({"done": True, "summary": result.get("summary", "")}).decode() + "\n"
+
+            return Response(stream_with_context(event_stream()), mimetype='application/x-ndjson')
+
+        responses = await asyncio.gather(
+            *(cached_generate(p, "clauses", prefix=SYSTEM_PREFIX_CLAUSES) for p in prompts)
+        )
+        partials = []
+        for response_text in responses:
+            partials.append(decode_response(_clause_decoder, response_text))
+        result = partials[0] if len(partials) == 1 else merge_clause_results(partials)
 
-        response = model.generate_content(prompt)
-        response_text = response.text.strip()
-        
-        # Clean JSON from markdown code blocks
-        if response_text.startswith("```"):
-            response_text = re.sub(r'^```json\s*|\s*```$', '', response_text, flags=re.MULTILINE)
-        
-        result = json.loads(response_text)
-        
         # Cache the analysis
-        analysis_cache[doc_id] = result
-        documents_db[doc_id]['processed'] = True
+        store_analysis(doc_id, result)
+        mark_document_processed(doc_id)
         
         return jsonify({
             "success": True,
@@ -174,108 +821,63 @@ Be thorough and extract ALL meaningful clauses. Use precise legal language."""
             "summary": result.get("summary", "")
         })
         
-    except json.JSONDecodeError as e:
+    except msgspec.DecodeError as e:
         return jsonify({"error": f"Failed to parse AI response: {str(e)}", "raw_response": response_text}), 500
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/analyze-compliance', methods=['POST'])
-def analyze_compliance():
+async def analyze_compliance():
     """Perform deep compliance analysis across regulations"""
     try:
         data = request.json
         doc_id = data.get('doc_id')
         regulations = data.get('regulations', ['GDPR', 'HIPAA', 'CCPA'])
         
-        if doc_id not in documents_db:
+        meta = get_document_meta(doc_id)
+        if meta is None:
             return jsonify({"error": "Document not found"}), 404
-        
-        if doc_id not in analysis_cache:
+
+        clauses_data = get_analysis(doc_id)
+        if clauses_data is None:
             return jsonify({"error": "Please extract clauses first"}), 400
         
-        document = documents_db[doc_id]
-        clauses_data = analysis_cache[doc_id]
-        
-        regulations_context = {
-            "GDPR": "EU General Data Protection Regulation - focuses on data subject rights, consent, data minimization, retention limits, right to erasure, breach notification",
-            "HIPAA": "Health Insurance Portability and Accountability Act - protects health information privacy, requires security safeguards, breach notification",
-            "CCPA": "California Consumer Privacy Act - consumer rights to know, delete, opt-out of data sales",
-            "SOC2": "System and Organization Controls 2 - security, availability, processing integrity, confidentiality, privacy",
-            "PCI-DSS": "Payment Card Industry Data Security Standard - protect cardholder data, secure networks, access control"
-        }
-        
-        selected_regs = {reg: regulations_context.get(reg, reg) for reg in regulations}
-        
-        prompt = f"""You are an expert legal compliance analyst specializing in regulatory risk assessment.
-
-Perform comprehensive compliance analysis for the following document against specified regulations.
+        unknown_regs = [reg for reg in regulations if reg not in REG_JSON]
+        if unknown_regs:
+            return jsonify({"error": f"Unknown regulations: {', '.join(unknown_regs)}"}), 400
 
-Document: {document['filename']}
-Extracted Clauses Analysis:
-{json.dumps(clauses_data, indent=2)}
-
-Regulations to Check:
-{json.dumps(selected_regs, indent=2)}
-
-Perform deep legal reasoning to identify:
-
-1. **Direct Violations** - clauses that explicitly violate regulations
-2. **Partial Compliance** - clauses that partially meet requirements but have gaps
-3. **Missing Clauses** - required clauses absent from the document
-4. **Contradictory Obligations** - internal conflicts or cross-regulation conflicts
-5. **Regulatory Mapping** - map each clause to relevant regulation articles
-
-For EACH issue found, provide:
-- **Issue Type** (violation, gap, conflict, partial)
-- **Severity** (Low, Medium, High, Critical)
-- **Affected Clause** (clause_id and text)
-- **Regulation** (which regulation and specific article)
-- **Legal Reasoning** (explain WHY this is a problem using legal principles)
-- **Penalty Exposure** (potential consequences)
-- **Remediation** (specific actionable fix)
-
-Return analysis in valid JSON:
-{{
-  "compliance_score": 0-100,
-  "total_issues": number,
-  "issues": [
-    {{
-      "issue_id": "I1",
-      "issue_type": "violation",
-      "severity": "Critical",
-      "affected_clause_id": "C1",
-      "clause_text": "...",
-      "regulation": "GDPR Article 17",
-      "legal_reasoning": "This clause permits indefinite data storage, which directly conflicts with GDPR Article 5(1)(e) requiring data minimization and storage limitation. Under GDPR, personal data must not be kept longer than necessary.",
-      "penalty_exposure": "Up to €20 million or 4% of annual global turnover",
-      "remediation": "Introduce maximum retention period of 24 months with documented justification"
-    }}
-  ],
-  "regulation_coverage": {{}},
-  "risk_summary": "Executive summary"
-}}
+        # Fan out one Gemini call per regulation so wall-clock time is the max
+        # latency instead of the sum, with a smaller prompt per call
+        clauses_json = orjson.dumps(clauses_data, option=orjson.OPT_INDENT_2).decode()
+        prompts = [
+            build_single_reg_prompt(meta.filename, clauses_json, REG_JSON[reg])
+            for reg in regulations
+        ]
+        responses = await asyncio.gather(
+            *(cached_generate(p, "compliance", prefix=SYSTEM_PREFIX_COMPLIANCE) for p in prompts)
+        )
 
-Use precise legal reasoning. Ground all findings in provided text."""
+        result = merge_compliance_results(responses)
 
-        response = model.generate_content(prompt)
-        response_text = response.text.strip()
-        
-        if response_text.startswith("```"):
-            response_text = re.sub(r'^```json\s*|\s*```$', '', response_text, flags=re.MULTILINE)
-        
-        result = json.loads(response_text)
-        
-        # Cache compliance analysis
-        analysis_cache[f"{doc_id}_compliance"] = result
+        # Cache compliance analysis, plus an issue_id index under its own key
+        # so explain_risk resolves issues in O(1) without the index ever
+        # leaking into API payloads or downstream prompts
+        store_analysis(f"{doc_id}_compliance", result)
+        store_analysis(f"{doc_id}_issue_index", {
+            issue.get("issue_id"): issue for issue in result.get("issues", [])
+        })
+        # Issue ids were just re-indexed, so any cached duplicate pairs from a
+        # previous run reference the wrong issues
+        delete_analysis(f"{doc_id}_duplicates")
         
         return jsonify({
             "success": True,
             "doc_id": doc_id,
             "analysis": result
         })
-        
-    except json.JSONDecodeError as e:
-        return jsonify({"error": f"Failed to parse AI response: {str(e)}", "raw_response": response_text}), 500
+
+    except msgspec.DecodeError as e:
+        return jsonify({"error": f"Failed to parse AI response: {str(e)}"}), 500
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -286,38 +888,44 @@ def generate_risk_heatmap():
         data = request.json
         doc_id = data.get('doc_id')
         
-        compliance_key = f"{doc_id}_compliance"
-        if compliance_key not in analysis_cache:
+        compliance_data = get_analysis(f"{doc_id}_compliance")
+        if compliance_data is None:
             return jsonify({"error": "No compliance analysis found"}), 404
-        
-        compliance_data = analysis_cache[compliance_key]
         issues = compliance_data.get("issues", [])
         
         # Group by severity
-        severity_counts = {"Low": 0, "Medium": 0, "High": 0, "Critical": 0}
-        regulation_risks = {}
-        clause_risks = {}
-        
+        severity_counts = Counter()
+        regulation_risks = Counter()
+        clause_risks = defaultdict(list)
+
         for issue in issues:
             severity = issue.get("severity", "Medium")
-            severity_counts[severity] = severity_counts.get(severity, 0) + 1
-            
-            regulation = issue.get("regulation", "Unknown")
-            regulation_risks[regulation] = regulation_risks.get(regulation, 0) + 1
-            
-            clause_id = issue.get("affected_clause_id", "Unknown")
-            clause_risks[clause_id] = clause_risks.get(clause_id, [])
-            clause_risks[clause_id].append({
+            severity_counts[severity] += 1
+            regulation_risks[issue.get("regulation", "Unknown")] += 1
+            clause_risks[issue.get("affected_clause_id", "Unknown")].append({
                 "severity": severity,
                 "issue_type": issue.get("issue_type")
             })
-        
+
+        # Embeddings are batched once per document and the resulting pairs
+        # cached, so repeat heatmap requests skip the embedding call entirely
+        duplicate_pairs = get_analysis(f"{doc_id}_duplicates")
+        if duplicate_pairs is None:
+            duplicate_pairs = find_duplicate_issue_pairs(issues) if len(issues) > 1 else []
+            if duplicate_pairs is not None:
+                store_analysis(f"{doc_id}_duplicates", duplicate_pairs)
+            else:
+                # transient embedding failure: respond without pairs but leave
+                # the cache empty so the next request retries
+                duplicate_pairs = []
+
         return jsonify({
             "success": True,
             "heatmap_data": {
-                "severity_distribution": severity_counts,
-                "regulation_risks": regulation_risks,
-                "clause_risks": clause_risks,
+                "severity_distribution": {"Low": 0, "Medium": 0, "High": 0, "Critical": 0, **severity_counts},
+                "regulation_risks": dict(regulation_risks),
+                "clause_risks": dict(clause_risks),
+                "duplicate_issue_pairs": duplicate_pairs,
                 "total_issues": len(issues)
             }
         })
@@ -326,7 +934,7 @@ def generate_risk_heatmap():
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/explain-risk', methods=['POST'])
-def explain_risk():
+async def explain_risk():
     """Generate human-readable explanation for specific risk"""
     try:
         data = request.json
@@ -334,19 +942,17 @@ def explain_risk():
         doc_id = data.get('doc_id')
         audience = data.get('audience', 'executive')  # executive, engineer, legal
         
-        compliance_key = f"{doc_id}_compliance"
-        if compliance_key not in analysis_cache:
+        compliance_data = get_analysis(f"{doc_id}_compliance")
+        if compliance_data is None:
             return jsonify({"error": "No compliance analysis found"}), 404
-        
-        compliance_data = analysis_cache[compliance_key]
-        issues = compliance_data.get("issues", [])
-        
-        target_issue = None
-        for issue in issues:
-            if issue.get("issue_id") == issue_id:
-                target_issue = issue
-                break
-        
+        issue_index = get_analysis(f"{doc_id}_issue_index")
+        if issue_index is None:
+            issue_index = {
+                issue.get("issue_id"): issue
+                for issue in compliance_data.get("issues", [])
+            }
+        target_issue = issue_index.get(issue_id)
+
         if not target_issue:
             return jsonify({"error": "Issue not found"}), 404
         
@@ -359,7 +965,7 @@ def explain_risk():
         prompt = f"""You are translating a legal compliance issue for a {audience} audience.
 
 Issue Details:
-{json.dumps(target_issue, indent=2)}
+{orjson.dumps(target_issue, option=orjson.OPT_INDENT_2).decode()}
 
 {audience_instructions.get(audience, '')}
 
@@ -372,11 +978,8 @@ Provide a clear, well-structured explanation covering:
 Use markdown formatting with **bold** for emphasis and bullet points for clarity.
 Make it sound like advice from a trusted advisor, not a robot."""
 
-        response = model.generate_content(prompt)
-        html_response = markdown2.markdown(
-            response.text,
-            extras=["fenced-code-blocks", "tables", "strike", "cuddled-lists"]
-        )
+        explanation_text = await cached_generate(prompt, "explain")
+        html_response = md_to_html(explanation_text)
         
         return jsonify({
             "success": True,
@@ -393,68 +996,31 @@ def list_documents():
     docs = [
         {
             "id": doc_id,
-            "filename": doc["filename"],
-            "doc_type": doc["doc_type"],
-            "upload_time": doc["upload_time"],
-            "processed": doc["processed"]
+            "filename": meta.filename,
+            "doc_type": meta.doc_type,
+            "upload_time": meta.upload_time,
+            "processed": meta.processed
         }
-        for doc_id, doc in documents_db.items()
+        for doc_id, meta in list_document_metas()
     ]
     return jsonify({"documents": docs})
 
 @app.route('/api/remediation-plan', methods=['POST'])
-def generate_remediation_plan():
+async def generate_remediation_plan():
     """Generate comprehensive remediation plan"""
     try:
         data = request.json
         doc_id = data.get('doc_id')
         
-        compliance_key = f"{doc_id}_compliance"
-        if compliance_key not in analysis_cache:
+        compliance_data = get_analysis(f"{doc_id}_compliance")
+        if compliance_data is None:
             return jsonify({"error": "No compliance analysis found"}), 404
         
-        compliance_data = analysis_cache[compliance_key]
-        
-        prompt = f"""You are a legal operations strategist creating an actionable remediation plan.
-
-Based on this compliance analysis:
-{json.dumps(compliance_data, indent=2)[:10000]}
-
-Create a prioritized remediation roadmap that includes:
+        prompt = f"""Compliance Analysis:
+{orjson.dumps(compliance_data, option=orjson.OPT_INDENT_2).decode()[:10000]}"""
 
-1. **Immediate Actions** (Critical severity - do within 7 days)
-2. **Short-term Fixes** (High severity - do within 30 days)
-3. **Medium-term Improvements** (Medium severity - do within 90 days)
-4. **Long-term Enhancements** (Low severity - continuous improvement)
-
-For EACH recommendation:
-- **Action Title** - clear, specific task
-- **Detailed Steps** - how to implement
-- **Responsible Party** - who should do this (Legal, Engineering, Compliance, etc.)
-- **Estimated Effort** - time/resources required
-- **Dependencies** - what needs to happen first
-- **Success Criteria** - how to verify completion
-
-Return as valid JSON:
-{{
-  "plan_summary": "Executive overview",
-  "immediate_actions": [],
-  "short_term": [],
-  "medium_term": [],
-  "long_term": [],
-  "estimated_timeline": "X weeks",
-  "total_actions": number
-}}
-
-Make recommendations specific and actionable, not generic advice."""
-
-        response = model.generate_content(prompt)
-        response_text = response.text.strip()
-        
-        if response_text.startswith("```"):
-            response_text = re.sub(r'^```json\s*|\s*```$', '', response_text, flags=re.MULTILINE)
-        
-        result = json.loads(response_text)
+        response_text = await cached_generate(prompt, "remediation", prefix=SYSTEM_PREFIX_REMEDIATION)
+        result = decode_response(_remediation_decoder, response_text)
         
         return jsonify({
             "success": True,
@@ -464,5 +1030,10 @@ Make recommendations specific and actionable, not generic advice."""
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# ASGI entry point so the async LLM routes share a few event-loop workers
+# instead of pinning a WSGI thread per in-flight Gemini call:
+#   uvicorn app:asgi_app --workers 4
+asgi_app = WsgiToAsgi(app)
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file